@@ -83,7 +83,9 @@ def keep_trying(tries, delay, method, name, *args, **kwargs):
 
 class MtmClient(object):
 
-    def __init__(self, dsns, n_accounts=100000):
+    # init=False attaches to a cluster previously initialized by another
+    # MtmClient instead of creating it from scratch
+    def __init__(self, dsns, n_accounts=100000, init=True):
         # logging.basicConfig(level=logging.DEBUG)
         self.n_accounts = n_accounts
         self.dsns = dsns
@@ -95,10 +97,13 @@ class MtmClient(object):
         # each dict is aggname_prefix => list of MtmTxAggregate, one for each
         # coroutine
         self.aggregates = [{} for e in dsns]
-        keep_trying(40, 1, self.create_extension, 'self.create_extension')
+        self.evloop_process = None
+        if init:
+            keep_trying(40, 1, self.create_extension, 'self.create_extension')
         keep_trying(40, 1, self.await_nodes, 'self.await_nodes')
 
-        self.initdb()
+        if init:
+            self.initdb()
 
         log.info('initialized')
 
@@ -147,6 +152,14 @@ class MtmClient(object):
         finally:
             conn.close()
 
+    # restore the initial state of tables, e.g. between test classes sharing
+    # the cluster; the client must be stopped
+    def reset_accounts(self):
+        self.execute(0, [
+            'update bank_test set amount = 0',
+            'delete from insert_test'
+        ])
+
     def execute(self, node_id, statements):
         con = psycopg2.connect(self.dsns[node_id])
         try:
@@ -211,17 +224,18 @@ class MtmClient(object):
                 con = psycopg2.connect(dsn)
                 try:
                     cur = con.cursor()
+                    # Both digests are computed by the server in one round
+                    # trip; ORDER BY inside the aggregate, unlike ordered
+                    # subquery, guarantees the order.
                     cur.execute("""
                     select
-                    md5('(' || string_agg(uid::text || ', ' || amount::text , '),(') || ')')
-                    from
-                    (select * from bank_test order by uid) t;""")
-                    hashes.add(cur.fetchone()[0])
-
-                    cur.execute("""
-                    select md5(string_agg(id, ','))
-                    from (select id from insert_test order by id) t;""")
-                    hashes2.add(cur.fetchone()[0])
+                    (select md5('(' || string_agg(uid::text || ', ' || amount::text, '),(' order by uid) || ')')
+                     from bank_test),
+                    (select md5(string_agg(id, ',' order by id))
+                     from insert_test);""")
+                    bank_hash, insert_hash = cur.fetchone()
+                    hashes.add(bank_hash)
+                    hashes2.add(insert_hash)
                     cur.close()
                 finally:
                     con.close()
@@ -0,0 +1,347 @@
+#
+# Brings up services of a compose file directly through the docker API, which
+# is much cheaper than forking docker-compose each time. Only the subset of
+# compose syntax used by our support/*.yml files is understood.
+#
+
+import calendar
+import collections
+import concurrent.futures
+import fnmatch
+import hashlib
+import logging
+import os
+import subprocess
+import threading
+import time
+
+import docker
+import yaml
+
+from . import log_helper  # configures loggers
+
+log = logging.getLogger('root.docker_stack')
+
+# image label holding hash of the build context the image was built from
+CONTEXT_HASH_LABEL = 'mmts.tests.context_hash'
+
+
+# Patterns of .dockerignore of the build context. Only plain patterns are
+# understood, not exceptions ('!') or '**'.
+def dockerignore_patterns(path):
+    try:
+        with open(os.path.join(path, '.dockerignore')) as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        return []
+    return [line.strip('/') for line in lines
+            if line and not line.startswith('#')]
+
+
+# whether path relative to the context or any of its parent dirs matches
+def is_dockerignored(path, patterns):
+    parts = path.split('/')
+    return any(fnmatch.fnmatchcase('/'.join(parts[:i]), pattern)
+               for pattern in patterns for i in range(1, len(parts) + 1))
+
+
+# Hash of files in the build context, or None if it can't be computed (e.g.
+# the sources are not a git checkout).
+def context_hash(path):
+    try:
+        files = subprocess.check_output(
+            ['git', 'ls-files', '-z', '--cached', '--others',
+             '--exclude-standard'], cwd=path, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    patterns = dockerignore_patterns(path)
+    h = hashlib.sha1()
+    for f in sorted(files.split(b'\0')):
+        fpath = os.path.join(path, os.fsdecode(f))
+        # listed, but deleted in the working tree
+        if not f or not os.path.isfile(fpath):
+            continue
+        if is_dockerignored(os.fsdecode(f), patterns):
+            continue
+        fh = hashlib.sha1()
+        with open(fpath, 'rb') as fd:
+            for block in iter(lambda: fd.read(1 << 20), b''):
+                fh.update(block)
+        h.update(f + b'\0')
+        h.update(fh.digest())
+    return h.hexdigest()
+
+
+class DockerStack(object):
+
+    # The file is parsed immediately, docker is contacted only when needed.
+    # service_overrides are applied to each service: environment is merged
+    # into the service's one, other keys replace the service's ones; image
+    # replaces build.
+    def __init__(self, compose_file, docker_api=None, service_overrides=None):
+        self.project_dir = os.path.dirname(os.path.abspath(compose_file))
+        # images, containers and networks are named after the project like
+        # docker-compose does
+        self.project = os.path.basename(self.project_dir)
+        with open(compose_file) as f:
+            config = yaml.safe_load(f)
+        self.services = config['services']
+        for service in self.services.values():
+            for key, value in (service_overrides or {}).items():
+                if key == 'environment':
+                    service.setdefault(key, {}).update(value)
+                else:
+                    service[key] = value
+                if key == 'image':
+                    service.pop('build', None)
+        self.networks = config.get('networks', {})
+        self._docker_api = docker_api
+        self._built = False
+
+    @property
+    def docker_api(self):
+        if self._docker_api is None:
+            timeout = os.environ.get('DOCKER_CLIENT_TIMEOUT')
+            if timeout is not None:
+                timeout = int(timeout)
+            self._docker_api = docker.from_env(timeout=timeout)
+        return self._docker_api
+
+    def image_tag(self, service):
+        return '{}_{}'.format(self.project, service)
+
+    # name of the image the service runs
+    def image_name(self, service):
+        return self.services[service].get('image', self.image_tag(service))
+
+    def image_id(self, service):
+        return self.docker_api.images.get(self.image_name(service)).id
+
+    def network_name(self, network):
+        return '{}_{}'.format(self.project, network)
+
+    # Build image from context unless it is already built from the current
+    # state of the context; tag it for each of the services.
+    def _build_context(self, context, services):
+        tag = self.image_tag(services[0])
+        chash = context_hash(context)
+        try:
+            image = self.docker_api.images.get(tag)
+        except docker.errors.ImageNotFound:
+            image = None
+
+        if (chash is None or image is None or
+                image.labels.get(CONTEXT_HASH_LABEL) != chash):
+            log.info('building image {} from {}'.format(tag, context))
+            image, _ = self.docker_api.images.build(
+                path=context, tag=tag, rm=True,
+                cache_from=[tag] if image is not None else None,
+                labels={CONTEXT_HASH_LABEL: chash or ''})
+        else:
+            log.info('image {} is up to date'.format(tag))
+
+        for name in services[1:]:
+            image.tag(self.image_tag(name))
+
+    # Build images of services which have 'build', once per process. Services
+    # sharing the build context share the image; distinct contexts are built
+    # in parallel.
+    def build(self):
+        if self._built:
+            return
+
+        contexts = {}  # context path => services
+        for name, service in self.services.items():
+            if 'build' in service:
+                context = os.path.normpath(os.path.join(self.project_dir,
+                                                        service['build']))
+                contexts.setdefault(context, []).append(name)
+
+        if contexts:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(contexts)) as executor:
+                # list() to reraise exceptions
+                list(executor.map(self._build_context, contexts,
+                                  contexts.values()))
+        self._built = True
+
+    def _create_network(self, name, network):
+        netname = self.network_name(name)
+        try:
+            return self.docker_api.networks.get(netname)
+        except docker.errors.NotFound:
+            pass
+
+        ipam = None
+        if 'ipam' in network:
+            ipam = docker.types.IPAMConfig(pool_configs=[
+                docker.types.IPAMPool(subnet=c.get('subnet'),
+                                      gateway=c.get('gateway'))
+                for c in network['ipam'].get('config', [])])
+        return self.docker_api.networks.create(
+            netname, driver=network.get('driver'), ipam=ipam)
+
+    def _remove_container(self, name):
+        try:
+            self.docker_api.containers.get(name).remove(force=True)
+        except docker.errors.NotFound:
+            pass
+
+    # (Re)create container of the service and start it. Without recreate
+    # existing container is just started if it is not running.
+    def _run_service(self, name, recreate=True):
+        service = self.services[name]
+        api = self.docker_api.api
+        cname = service.get('container_name', name)
+        image = self.image_name(name)
+
+        if not recreate:
+            try:
+                container = self.docker_api.containers.get(cname)
+                if container.status != 'running':
+                    container.start()
+                    log.info('started {}'.format(cname))
+                return
+            except docker.errors.NotFound:
+                pass
+        self._remove_container(cname)
+
+        port_bindings = {}
+        for p in service.get('ports', []):
+            host_port, container_port = str(p).split(':')
+            port_bindings[int(container_port)] = int(host_port)
+        ulimits = [docker.types.Ulimit(name=k, soft=v, hard=v)
+                   for k, v in service.get('ulimits', {}).items()]
+        environment = {k: str(v)
+                       for k, v in service.get('environment', {}).items()}
+        # host paths are relative to the compose file
+        binds = []
+        for v in service.get('volumes', []):
+            host_path, rest = v.split(':', 1)
+            binds.append('{}:{}'.format(
+                os.path.normpath(os.path.join(self.project_dir, host_path)),
+                rest))
+        endpoints = {
+            self.network_name(net): api.create_endpoint_config(
+                ipv4_address=(cfg or {}).get('ipv4_address'))
+            for net, cfg in service.get('networks', {}).items()}
+
+        host_config = api.create_host_config(
+            binds=binds,
+            port_bindings=port_bindings,
+            shm_size=service.get('shm_size'),
+            privileged=service.get('privileged', False),
+            ulimits=ulimits,
+            network_mode=next(iter(endpoints), None))
+        container = api.create_container(
+            image, name=cname, detach=True,
+            ports=list(port_bindings),
+            volumes=[b.split(':')[1] for b in binds],
+            environment=environment,
+            entrypoint=service.get('entrypoint'),
+            command=service.get('command'),
+            user=service.get('user'),
+            host_config=host_config,
+            networking_config=api.create_networking_config(endpoints))
+        api.start(container['Id'])
+        log.info('started {}'.format(cname))
+
+    # Equivalent of 'docker-compose up --no-build [--force-recreate] -d';
+    # images must be already built
+    def up(self, recreate=True):
+        for name, network in self.networks.items():
+            self._create_network(name, network or {})
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self.services)) as executor:
+            # list() to reraise exceptions
+            list(executor.map(self._run_service, self.services,
+                              [recreate] * len(self.services)))
+
+    def down(self):
+        for name, service in self.services.items():
+            self._remove_container(service.get('container_name', name))
+        for name in self.networks:
+            try:
+                self.docker_api.networks.get(self.network_name(name)).remove()
+            except docker.errors.NotFound:
+                pass
+
+
+# Timestamp of docker log line (RFC3339Nano, UTC) as (seconds, nanoseconds)
+def parse_log_timestamp(ts):
+    secs, _, frac = ts.rstrip('Z').partition('.')
+    return (calendar.timegm(time.strptime(secs, '%Y-%m-%dT%H:%M:%S')),
+            int(frac.ljust(9, '0')[:9]))
+
+
+# Keeps the last maxlen lines of container log in memory, following the log
+# across container restarts, so it can be shown when a test fails without
+# streaming it all the time.
+class ContainerLogTail(object):
+
+    def __init__(self, container, maxlen=10000):
+        self.container = container
+        self.lines = collections.deque(maxlen=maxlen)
+        self._stream = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._follow, daemon=True)
+        self._thread.start()
+
+    def _follow(self):
+        # Timestamp of the last stored line. The stream is reattached (after
+        # container restart, read timeout on a quiet log etc) since its
+        # second, which docker allows only with 1s resolution, so lines up to
+        # it are skipped to avoid storing them twice.
+        last = (int(time.time()), 0)
+        while not self._stopped.is_set():
+            try:
+                self.container.reload()
+                if self.container.status != 'running':
+                    self._stopped.wait(1)
+                    continue
+                self._stream = self.container.logs(
+                    stream=True, follow=True, since=last[0], timestamps=True)
+                # line cut by the end of previous stream is fetched again
+                partial = ''
+                # stream ends when the container stops
+                for chunk in self._stream:
+                    text = partial + chunk.decode(errors='replace')
+                    lines = text.split('\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        ts, _, line = line.partition(' ')
+                        try:
+                            stamp = parse_log_timestamp(ts)
+                        except ValueError:
+                            stamp = None
+                        if stamp is not None:
+                            if stamp <= last:
+                                continue
+                            last = stamp
+                        self.lines.append(line)
+            except Exception as e:
+                if not self._stopped.is_set():
+                    log.debug('following log of {} failed: {}'.format(
+                        self.container.name, e))
+                    self._stopped.wait(1)
+
+    def stop(self):
+        self._stopped.set()
+        if self._stream is not None:
+            self._stream.close()
+
+
+# Allows to prebuild images (or manage the stack manually) out of tests, e.g.
+#   python3 -m lib.docker_stack support/two_nodes.yml build
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('compose_file')
+    parser.add_argument('command', choices=['build', 'up', 'down'])
+    args = parser.parse_args()
+
+    stack = DockerStack(args.compose_file)
+    getattr(stack, args.command)()
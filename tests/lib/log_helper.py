@@ -37,6 +37,9 @@ LOGGING = {
 	},
 	"root.bank_client": {
 	    "level": "INFO"
+	},
+	"root.docker_stack": {
+	    "level": "INFO"
 	}
     }
 }
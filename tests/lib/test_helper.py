@@ -1,3 +1,5 @@
+import atexit
+import concurrent.futures
 import unittest
 import time
 import datetime
@@ -9,8 +11,11 @@ import subprocess
 import logging
 import warnings
 
+import docker
+
 from .failure_injector import *
 from .bank_client import keep_trying, MtmClient
+from .docker_stack import ContainerLogTail, DockerStack, context_hash
 from . import log_helper  # configures loggers
 
 log = logging.getLogger('root.test_helper')
@@ -27,6 +32,14 @@ TEST_STOP_DELAY = 5
 # available as 'docker', see
 # https://docs.gitlab.com/ee/ci/docker/using_docker_images.html#accessing-the-services
 NODE_HOST = 'docker' if 'DOCKER_HOST' in os.environ else '127.0.0.1'
+# resolve hostname once during start as aoipg or docker have problems
+# with resolving hostname under a load
+NODE_HOST_IP = socket.gethostbyname(NODE_HOST)
+
+NODE1_DSN = f"dbname=regression user=postgres host={NODE_HOST_IP} port=15432"
+NODE2_DSN = f"dbname=regression user=postgres host={NODE_HOST_IP} port=15433"
+NODE3_DSN = f"dbname=regression user=postgres host={NODE_HOST_IP} port=15434"
+REFEREE_DSN = f"dbname=regression user=postgres host={NODE_HOST_IP} port=15435"
 
 # sometimes docker seems to randomly hang for a default 60s, see
 # https://github.com/docker/compose/issues/3927
@@ -34,6 +47,44 @@ NODE_HOST = 'docker' if 'DOCKER_HOST' in os.environ else '127.0.0.1'
 os.environ['DOCKER_CLIENT_TIMEOUT'] = '180'
 os.environ['COMPOSE_HTTP_TIMEOUT'] = '180'
 
+# two nodes + referee stack, shared by all TwoNodeCluster test classes
+TWO_NODES_COMPOSE = os.path.join(os.path.dirname(__file__), '..', 'support',
+                                 'two_nodes.yml')
+# MMTS_TESTS_MOUNT_SRC=1 runs the stack on the base pgmm image with mmts built
+# from the sources mounted from the host at container start (see
+# support/src-entrypoint.sh), so changes of sources don't require rebuilding
+# an image. Bind mounts need local docker, so it is for local runs only.
+TWO_NODES_MOUNT_SRC = os.environ.get('MMTS_TESTS_MOUNT_SRC') == '1'
+TWO_NODES_SRC_DIR = os.path.join(os.path.dirname(__file__), '..', '..')
+TWO_NODES_SRC_OVERRIDES = {
+    'image': 'pgmm',
+    'user': 'root',
+    # relative to the compose file
+    'volumes': ['../..:/mmts:ro'],
+    'entrypoint': ['/mmts/tests/support/src-entrypoint.sh'],
+    'command': ['postgres'],
+    'environment': {'USE_PGXS': 1, 'PGDATA': '/pg/data'},
+}
+TWO_NODES = DockerStack(
+    TWO_NODES_COMPOSE,
+    service_overrides=TWO_NODES_SRC_OVERRIDES if TWO_NODES_MOUNT_SRC else None)
+# Holds id of node1 container of the stack initialized by tests, its mode
+# (image or src), the id of the node1 image and, in src mode, hash of the
+# sources it was created from; lets later runs reuse the stack instead of
+# recreating it as long as the image and the sources are current. Exists only
+# while the stack is clean: it is removed when a test class starts using the
+# stack and written back once tearDownClass has restored the invariants, so
+# an interrupted run leaves nothing to reuse.
+TWO_NODES_LOCKFILE = '/tmp/mmts_two_nodes.up'
+# MtmClient of the stack once it is up in this process and the lockfile
+# contents describing the stack
+_two_nodes_client = None
+_two_nodes_lock = None
+
+# background wait for the client started by TestHelper.bgrunDeferred
+_warmup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+_client_warmup = None
+
 class MMTestCase(unittest.TestCase):
     @classmethod
     def collectLogs(cls, referee=False):
@@ -50,15 +101,7 @@ class MMTestCase(unittest.TestCase):
     # get 3 nodes up
     @classmethod
     def setUpClass(cls):
-        # resolve hostname once during start as aoipg or docker have problems
-        # with resolving hostname under a load
-        cls.host_ip = socket.gethostbyname(NODE_HOST)
-
-        cls.dsns = [
-            f"dbname=regression user=postgres host={cls.host_ip} port=15432",
-            f"dbname=regression user=postgres host={cls.host_ip} port=15433",
-            f"dbname=regression user=postgres host={cls.host_ip} port=15434"
-        ]
+        cls.dsns = [NODE1_DSN, NODE2_DSN, NODE3_DSN]
         cls.test_ok = True
 
         subprocess.check_call(['docker-compose', 'up', '--force-recreate',
@@ -85,15 +128,9 @@ class MMTestCase(unittest.TestCase):
     def tearDownClass(cls):
         log.info('tearDownClass')
 
-        # ohoh
-        th = TestHelper()
-        th.client = cls.client
-
         # collect logs for CI anyway
         try:
-            # skip the check if test already failed
-            if cls.test_ok:
-                th.assertDataSync()
+            cls.assertClassDataSync()
         finally:
             cls.client.stop()
             # Destroying containers is really unhelpful for local debugging, so
@@ -102,10 +139,22 @@ class MMTestCase(unittest.TestCase):
             if 'CI' in os.environ:
                 subprocess.check_call(['docker-compose', 'down'])
 
+    # TestHelper.assertDataSync for tearDownClass; skipped if a test has
+    # already failed
+    @classmethod
+    def assertClassDataSync(cls):
+        if not cls.test_ok:
+            return
+        # ohoh
+        th = TestHelper()
+        th.client = cls.client
+        th.assertDataSync()
+
     def setUp(self):
         # xxx why do we need this
         warnings.simplefilter("ignore", ResourceWarning)
         time.sleep(20)
+        TestHelper.awaitClientWarmup()
         log.info('start new test')
 
     # For use in tearDown; says whether the test has failed. Unfortunately
@@ -128,6 +177,192 @@ class MMTestCase(unittest.TestCase):
         log.info('finish test')
 
 
+# Two nodes and referee from TWO_NODES_COMPOSE. The stack is brought up once
+# and shared by all test classes (and by subsequent runs if it is still up);
+# tearDownClass only restores the data invariants.
+class TwoNodeCluster(MMTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        global _two_nodes_client
+
+        cls.dsns = [NODE1_DSN, NODE2_DSN]
+        cls.referee_dsn = REFEREE_DSN
+        cls.test_ok = True
+        # unlike test_ok, which reflects only the last test, set once anything
+        # in the class has failed; the stack is not reused then
+        cls.stack_dirty = False
+        # one docker client (and its connection pool) for the whole class
+        cls.docker_api = TWO_NODES.docker_api
+
+        try:
+            if _two_nodes_client is None:
+                _two_nodes_client = cls._twoNodesUp()
+            cls.client = _two_nodes_client
+            # tests are about to mess with the stack
+            if os.path.exists(TWO_NODES_LOCKFILE):
+                os.remove(TWO_NODES_LOCKFILE)
+            cls.client.bgrun()
+            cls.referee_container = cls.docker_api.containers.get('referee')
+            cls.log_tails = {
+                name: ContainerLogTail(cls.docker_api.containers.get(name))
+                for name in ['node1', 'node2', 'referee']}
+        except Exception as e:
+            # collect logs even if fail in setupClass
+            cls.collectLogs(referee=True)
+            raise e
+
+    # Run statement with psql inside the referee container, i.e. over unix
+    # socket, and return its unaligned tuples-only output.
+    @classmethod
+    def refereeQuery(cls, statement):
+        res = cls.referee_container.exec_run(
+            ['psql', '-U', 'postgres', '-d', 'regression', '-tAc', statement])
+        output = res.output.decode().strip()
+        if res.exit_code != 0:
+            raise Exception('referee query "{}" failed: {}'.format(
+                statement, output))
+        return output
+
+    # Whether postgres of all nodes and referee accepts connections
+    @classmethod
+    def _twoNodesReachable(cls):
+        for dsn in cls.dsns + [cls.referee_dsn]:
+            try:
+                psycopg2.connect(dsn + " connect_timeout=2").close()
+            except psycopg2.Error:
+                return False
+        return True
+
+    @classmethod
+    def _twoNodesUp(cls):
+        global _two_nodes_lock
+
+        try:
+            node1 = cls.docker_api.containers.get('node1')
+        except docker.errors.NotFound:
+            node1 = None
+        try:
+            with open(TWO_NODES_LOCKFILE) as f:
+                (initialized_id, initialized_mode, initialized_image,
+                 initialized_src) = f.read().split()
+        except (FileNotFoundError, ValueError):
+            (initialized_id, initialized_mode, initialized_image,
+             initialized_src) = None, None, None, None
+        mode = 'src' if TWO_NODES_MOUNT_SRC else 'image'
+
+        # images are rebuilt only if their sources have changed, so this is
+        # cheap when the stack is reused
+        TWO_NODES.build()
+        image_id = TWO_NODES.image_id('node1')
+        # In src mode mmts is compiled only when a container is created, so
+        # changed sources require recreation; it is forced if they can't be
+        # hashed.
+        src_hash = context_hash(TWO_NODES_SRC_DIR) if TWO_NODES_MOUNT_SRC \
+            else '-'
+
+        # Reuse the stack initialized by tests as is if it is reachable and
+        # runs the current image and sources; otherwise try to just start its
+        # stopped containers and recreate them only if that doesn't help.
+        reuse = (node1 is not None and node1.id == initialized_id and
+                 initialized_mode == mode and
+                 node1.image.id == image_id == initialized_image and
+                 src_hash is not None and src_hash == initialized_src)
+        if reuse and not cls._twoNodesReachable():
+            log.info('two nodes stack is not reachable, starting it')
+            TWO_NODES.up(recreate=False)
+            try:
+                TestHelper.pollUntil(cls._twoNodesReachable, timeout=60,
+                                     interval=1, what='two nodes stack start')
+            except AssertionError:
+                reuse = False
+        if not reuse:
+            TWO_NODES.up()
+        # tear the stack down once, at exit
+        atexit.unregister(cls._twoNodesDown)
+        atexit.register(cls._twoNodesDown)
+
+        # Wait for all nodes to become online
+        [cls.awaitOnline(dsn) for dsn in cls.dsns]
+
+        client = MtmClient(cls.dsns, n_accounts=1000, init=not reuse)
+        # create extension on referee
+        cls.nodeExecute(cls.referee_dsn,
+                        ['create extension if not exists referee'])
+
+        _two_nodes_lock = '{} {} {} {}'.format(
+            cls.docker_api.containers.get('node1').id, mode, image_id,
+            src_hash)
+        return client
+
+    @staticmethod
+    def _twoNodesDown():
+        # Destroying containers is really unhelpful for local debugging, so
+        # do this automatically only in CI.
+        if 'CI' in os.environ:
+            if os.path.exists(TWO_NODES_LOCKFILE):
+                os.remove(TWO_NODES_LOCKFILE)
+            TWO_NODES.down()
+
+    def setUp(self):
+        super().setUp()
+        self.containers = self._refreshContainers()
+        self.addCleanup(self._dumpLogsIfFailed)
+
+    def tearDown(self):
+        super().tearDown()
+        if not self.test_ok:
+            self.__class__.stack_dirty = True
+
+    def _dumpLogsIfFailed(self):
+        if self.lastTestOk():
+            return
+        for name, tail in self.log_tails.items():
+            log.error('last {} log lines of {}:\n{}'.format(
+                len(tail.lines), name, '\n'.join(tail.lines)))
+
+    # the stack is in unknown state, recreate it next time; the lockfile is
+    # already removed by setUpClass
+    @classmethod
+    def _invalidateTwoNodes(cls):
+        global _two_nodes_client
+
+        _two_nodes_client = None
+
+    @classmethod
+    def tearDownClass(cls):
+        log.info('tearDownClass')
+
+        # collect logs for CI anyway
+        try:
+            cls.assertClassDataSync()
+        except Exception:
+            cls.stack_dirty = True
+            raise
+        finally:
+            # don't stop the client under the background warm-up wait
+            try:
+                TestHelper.awaitClientWarmup()
+            except AssertionError as e:
+                log.error('client warm-up failed: {}'.format(e))
+            cls.client.stop()
+            for tail in cls.log_tails.values():
+                tail.stop()
+            cls.collectLogs(referee=True)
+            if cls.stack_dirty:
+                cls._invalidateTwoNodes()
+            else:
+                # keep the stack for the next class, just restore invariants
+                try:
+                    cls.refereeQuery('delete from referee.decision')
+                    cls.client.reset_accounts()
+                except Exception:
+                    cls._invalidateTwoNodes()
+                    raise
+                with open(TWO_NODES_LOCKFILE, 'w') as f:
+                    f.write(_two_nodes_lock)
+
+
 class TestHelper(object):
     def assertIsolation(self, aggs):
         isolated = True
@@ -152,7 +387,30 @@ class TestHelper(object):
         if commits:
             raise AssertionError('There are commits during aggregation interval')
 
+    # Check aggregates of all nodes in one pass: there must be no isolation
+    # errors anywhere, and node i must have commits iff commit_mask[i].
+    def assertAggs(self, aggs, commit_mask):
+        if len(aggs) != len(commit_mask):
+            raise AssertionError('Got aggregates of {} nodes, expected {}'.format(
+                len(aggs), len(commit_mask)))
+        for node_id, (agg, must_commit) in enumerate(zip(aggs, commit_mask)):
+            if agg['sumtotal']['isolation'] != 0:
+                raise AssertionError(
+                    'Isolation failure on node {}'.format(node_id + 1))
+            commits = 'commit' in agg['transfer']['finish']
+            if must_commit and not commits:
+                log.error('No commits during aggregation interval on node {}'
+                          .format(node_id + 1))
+                raise AssertionError(
+                    'No commits during aggregation interval on node {}'
+                    .format(node_id + 1))
+            if not must_commit and commits:
+                raise AssertionError(
+                    'There are commits during aggregation interval on node {}'
+                    .format(node_id + 1))
+
     def awaitCommit(self, node_id):
+        self.awaitClientWarmup()
         total_sleep = 0
 
         while total_sleep <= TEST_MAX_RECOVERY_TIME:
@@ -207,6 +465,76 @@ class TestHelper(object):
             'awaitOnline on {} exceeded timeout {}s'.format(
                 dsn, TEST_MAX_RECOVERY_TIME))
 
+    # Wait until predicate() holds, checking it every interval seconds
+    @staticmethod
+    def pollUntil(predicate, timeout=10, interval=0.1, what='condition'):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() >= deadline:
+                raise AssertionError(
+                    'pollUntil: {} not reached in {}s'.format(what, timeout))
+            time.sleep(interval)
+
+    # Wait until just started client gets going, i.e. has finished some
+    # transfers (successfully or not). Right after a node returns transfers
+    # may hang for multimaster.connect_timeout, so this is best effort only:
+    # whoever needs commits waits for them (awaitCommit).
+    def awaitClientStarted(self, timeout=30):
+        def started():
+            aggs = self.client.get_aggregates(clean=False, _print=False)
+            return any('transfer' in agg and agg['transfer']['finish']
+                       for agg in aggs)
+        try:
+            self.pollUntil(started, timeout=timeout, what='client start')
+        except AssertionError as e:
+            log.warning('{}, proceeding anyway'.format(e))
+
+    # Start the client, but don't wait for it to get going: the wait is done
+    # in background and joined by awaitClientWarmup when the client is
+    # needed next, e.g. by the next performFailure.
+    def bgrunDeferred(self):
+        global _client_warmup
+
+        self.client.bgrun()
+        _client_warmup = _warmup_executor.submit(self.awaitClientStarted)
+
+    @staticmethod
+    def awaitClientWarmup():
+        global _client_warmup
+
+        if _client_warmup is not None:
+            warmup, _client_warmup = _client_warmup, None
+            warmup.result()
+
+    # Containers by name, fetched in one docker API call. Returned objects
+    # stay usable for start/stop etc until containers are recreated; call
+    # reload() on one to see its current state.
+    def _refreshContainers(self):
+        return {c.name: c for c in self.docker_api.containers.list(all=True)}
+
+    # Start containers concurrently, then concurrently wait for dsns to get
+    # online. Waits begin only once all starts have succeeded: a wait retries
+    # for up to TEST_MAX_RECOVERY_TIME and can't be interrupted, so a failed
+    # start would otherwise be reported only after it.
+    def startAndAwait(self, containers, dsns):
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(len(containers), len(dsns), 1)) as executor:
+            # list() to reraise exceptions
+            list(executor.map(lambda c: c.start(), containers))
+            list(executor.map(self.awaitOnline, dsns))
+
+    # Stop the client and, concurrently, start containers and wait for dsns
+    # to get online. Final aggregates are fetched before the stop: both talk
+    # to the client through the same pipe, so they can't overlap.
+    def stopClientAndStart(self, containers, dsns):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            started = executor.submit(self.startAndAwait, containers, dsns)
+            self.awaitClientWarmup()
+            log.info('aggs before client stop:')
+            self.client.get_aggregates(clean=False)
+            self.client.stop()
+            started.result()
+
     def AssertNoPrepares(self):
         n_prepared = self.client.n_prepared_tx()
         if n_prepared != 0:
@@ -214,6 +542,7 @@ class TestHelper(object):
             raise AssertionError('There are some unfinished tx')
 
     def assertDataSync(self):
+        self.awaitClientWarmup()
         self.client.stop()
 
         try:
@@ -252,6 +581,15 @@ class TestHelper(object):
 
         self.client.bgrun()
 
+    # Aggregates of the load during duration seconds from now. Cheap
+    # replacement of performFailure(NoFailure()) when there is no failure to
+    # inject and recover from.
+    def sampleAggs(self, duration=TEST_DURATION):
+        self.awaitClientWarmup()
+        self.client.clean_aggregates()
+        time.sleep(duration)
+        return self.client.get_aggregates()
+
     def performRandomFailure(self, node, wait=0, nodes_wait_for_commit=[], nodes_wait_for_online=None, stop_load=False, nodes_assert_commit_during_failure=[]):
         FailureClass = random.choice(ONE_NODE_FAILURES)
         failure = FailureClass(node)
@@ -262,6 +600,7 @@ class TestHelper(object):
     def performFailure(self, failure, wait=0, nodes_wait_for_commit=[], nodes_wait_for_online=[], stop_load=False, nodes_assert_commit_during_failure=[]):
 
         time.sleep(TEST_WARMING_TIME)
+        self.awaitClientWarmup()
 
         log.info('simulate failure')
 
@@ -298,7 +637,7 @@ class TestHelper(object):
 
         if stop_load:
             self.client.bgrun()
-            time.sleep(3)
+            self.awaitClientStarted()
 
         for node_wait_for_commit in nodes_wait_for_commit:
             self.awaitCommit(node_wait_for_commit)
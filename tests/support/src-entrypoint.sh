@@ -0,0 +1,23 @@
+#!/bin/sh
+
+# Entrypoint of two_nodes.yml containers with MMTS_TESTS_MOUNT_SRC=1: instead
+# of baking mmts into the image, build and install it from the sources mounted
+# (read-only) at /mmts, then proceed as the image built from our Dockerfile
+# does. The build happens once per container; restarts of the container skip
+# it.
+
+set -e
+
+if [ ! -f /pg/mmts/.installed ]; then
+	rm -rf /pg/mmts
+	cp -r /mmts /pg/mmts
+	cd /pg/mmts
+	make clean
+	make -j4 install
+	# pg_regress client assumes such dir exists on server
+	cp /pg/src/src/test/regress/*.so /pg/install/lib/postgresql/
+	touch /pg/mmts/.installed
+	cd /
+fi
+
+exec su -p postgres -c "/pg/mmts/tests/docker-entrypoint.sh $*"
@@ -46,14 +46,13 @@ class RecoveryTest(MMTestCase, TestHelper):
         for i in range(1, 16):
             log.info(f'running round #{i} of test_random_disasters')
             node_number = random.choice(range(1, 4))
-            port = 15431 + node_number
 
             nodes_assert_commit_during_failure = [n for n in range(3) if n !=
                                                   node_number - 1]
             aggs_failure, aggs = self.performRandomFailure(
                 f'node{node_number}',
                 nodes_wait_for_commit=[n for n in range(3)],
-                nodes_wait_for_online=[f"dbname=regression user=postgres host={self.host_ip} port={port}"],
+                nodes_wait_for_online=[self.dsns[node_number - 1]],
                 stop_load=True,
                 nodes_assert_commit_during_failure=
                 nodes_assert_commit_during_failure)
@@ -84,9 +83,7 @@ class RecoveryTest(MMTestCase, TestHelper):
             # 10s of the test given that the load is not stopped. This actually
             # happened in CI. To avoid test failure, wait for both 1 and 3 to be
             # online.
-            nodes_wait_for_online=[
-                f"dbname=regression user=postgres host={self.host_ip} port=15434",
-                f"dbname=regression user=postgres host={self.host_ip} port=15432"],
+            nodes_wait_for_online=[NODE3_DSN, NODE1_DSN],
             stop_load=True)
 
         self.assertTrue(('commit' in aggs_failure[0]['transfer']['finish']) or
@@ -104,7 +101,7 @@ class RecoveryTest(MMTestCase, TestHelper):
         failure = CrashRecoverNode('node3')
         aggs_failure, aggs = self.performFailure(
             failure,
-            nodes_wait_for_online=["dbname=regression user=postgres host=127.0.0.1 port=15434"],
+            nodes_wait_for_online=[NODE3_DSN],
             stop_load=True)
 
         self.assertCommits(aggs_failure[:2])
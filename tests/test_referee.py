@@ -17,104 +17,38 @@ from lib.test_helper import *
 
 log = logging.getLogger('root')
 
-class RefereeTest(MMTestCase, TestHelper):
-    @classmethod
-    def setUpClass(cls):
-        host_ip = socket.gethostbyname(NODE_HOST)
-
-        cls.dsns = [
-            f"dbname=regression user=postgres host={host_ip} port=15432",
-            f"dbname=regression user=postgres host={host_ip} port=15433",
-        ]
-        cls.referee_dsn = f"dbname=regression user=postgres host={host_ip} port=15435"
-        cls.test_ok = True
-
-        subprocess.check_call(['docker-compose',
-            '-f', 'support/two_nodes.yml',
-            'up',
-            '--force-recreate',
-            '--build',
-            '-d'])
-
-        # Wait for all nodes to become online
-        try:
-            [cls.awaitOnline(dsn) for dsn in cls.dsns]
-
-            cls.client = MtmClient(cls.dsns, n_accounts=1000)
-            cls.client.bgrun()
-            # create extension on referee
-            cls.nodeExecute(cls.referee_dsn,
-                            ['create extension referee'])
-        except Exception as e:
-            # collect logs even if fail in setupClass
-            cls.collectLogs(referee=True)
-            raise e
-
-    @classmethod
-    def tearDownClass(cls):
-        log.info('tearDownClass')
-
-        # ohoh
-        th = TestHelper()
-        th.client = cls.client
-
-        # collect logs for CI anyway
-        try:
-            # skip the check if test already failed
-            if cls.test_ok:
-                th.assertDataSync()
-        finally:
-            cls.client.stop()
-            # Destroying containers is really unhelpful for local debugging, so
-            # do this automatically only in CI.
-            cls.collectLogs(referee=True)
-            if 'CI' in os.environ:
-                subprocess.check_call(['docker-compose', 'down'])
-
-
-    def test_neighbor_restart(self):
-        log.info('### test_neighbor_restart ###')
-
+class RefereeTest(TwoNodeCluster, TestHelper):
+    def _winnerDecisions(self):
+        return int(self.refereeQuery(
+            "select count(*) from referee.decision where key = 'winner'"))
+
+    # wait for the referee grant to be cleared; each probe is a docker exec,
+    # so don't poll too often
+    def _awaitDecisionCleaned(self):
+        self.pollUntil(lambda: self._winnerDecisions() == 0, timeout=60,
+                       interval=1, what='referee decision cleanup')
+
+    # fail node2 with failure_class, ensure node1 continues working
+    def _checkNeighborFailure(self, failure_class):
         aggs_failure, aggs = self.performFailure(
-            RestartNode('node2'), nodes_wait_for_online=[self.dsns[1]],
+            failure_class('node2'), nodes_wait_for_online=
+            [self.dsns[1]],
             stop_load=True)
 
-        self.assertCommits(aggs_failure[:1])
-        self.assertNoCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
+        self.assertAggs(aggs_failure, [True, False])
+        self.assertAggs(aggs, [True, True])
 
-        self.assertCommits(aggs)
-        self.assertIsolation(aggs)
+    def test_neighbor_restart(self):
+        log.info('### test_neighbor_restart ###')
+        self._checkNeighborFailure(RestartNode)
 
     def test_node_crash(self):
         log.info('### test_node_crash ###')
-
-        aggs_failure, aggs = self.performFailure(
-            CrashRecoverNode('node2'), nodes_wait_for_online=
-            [self.dsns[1]],
-            stop_load=True)
-
-        self.assertCommits(aggs_failure[:1])
-        self.assertNoCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertCommits(aggs)
-        self.assertIsolation(aggs)
+        self._checkNeighborFailure(CrashRecoverNode)
 
     def test_partition_referee(self):
         log.info('### test_partition_referee ###')
-
-        aggs_failure, aggs = self.performFailure(
-            SingleNodePartition('node2'), nodes_wait_for_online=
-            [self.dsns[1]],
-            stop_load=True)
-
-        self.assertCommits(aggs_failure[:1])
-        self.assertNoCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertCommits(aggs)
-        self.assertIsolation(aggs)
+        self._checkNeighborFailure(SingleNodePartition)
 
     # cut one node from neighbour and referee, ensure neighbour works as
     # winner, repair network, wait until isolated node gets online, repeat with
@@ -126,23 +60,15 @@ class RefereeTest(MMTestCase, TestHelper):
             SingleNodePartition('node2'), nodes_wait_for_online=
             [self.dsns[1]], stop_load=True)
 
-        self.assertCommits(aggs_failure[:1])
-        self.assertNoCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertCommits(aggs)
-        self.assertIsolation(aggs)
+        self.assertAggs(aggs_failure, [True, False])
+        self.assertAggs(aggs, [True, True])
 
         aggs_failure, aggs = self.performFailure(
             SingleNodePartition('node1'), nodes_wait_for_online=
             [self.dsns[0]], stop_load=True)
 
-        self.assertNoCommits(aggs_failure[:1])
-        self.assertCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertCommits(aggs)
-        self.assertIsolation(aggs)
+        self.assertAggs(aggs_failure, [False, True])
+        self.assertAggs(aggs, [True, True])
 
     # - get node 1 down, ensure 2 works as winner
     # - restart 2, ensure it continue working as winner
@@ -152,153 +78,79 @@ class RefereeTest(MMTestCase, TestHelper):
     # test_consequent_shutdown...
     def test_saved_referee_decision(self):
         log.info('### test_saved_referee_decision ###')
-        docker_api = docker.from_env()
 
         log.info('#### down on(winner) || on')
         log.info('###########################')
         aggs_failure, aggs = self.performFailure(StopNode('node1'))
 
-        self.assertNoCommits(aggs_failure[:1])
-        self.assertCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs[:1])
-        self.assertCommits(aggs[1:])
-        self.assertIsolation(aggs)
+        self.assertAggs(aggs_failure, [False, True])
+        self.assertAggs(aggs, [False, True])
 
         log.info('#### down restart(winner) || down')
         log.info('###########################')
-        docker_api.containers.get('referee').stop()
+        self.containers['referee'].stop()
         aggs_failure, aggs = self.performFailure(RestartNode('node2'),
                                                  nodes_wait_for_commit=[1])
 
         # without saved decision node2 will be endlessly disabled here
 
-        self.assertNoCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs[:1])
-        self.assertCommits(aggs[1:])
-        self.assertIsolation(aggs)
+        self.assertAggs(aggs_failure, [False, False])
+        self.assertAggs(aggs, [False, True])
 
         log.info('#### up down(winner) || down')
         log.info('###########################')
-        docker_api.containers.get('node2').stop()
-        docker_api.containers.get('node1').start()
-        aggs_failure, aggs = self.performFailure(NoFailure())
-
-        self.assertNoCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-        self.assertNoCommits(aggs)
-        self.assertIsolation(aggs)
+        self.containers['node2'].stop()
+        self.containers['node1'].start()
+        # sample node1 once it is up, not its boot; select works on disabled
+        # node
+        self.awaitOnline(self.dsns[0])
+        self.assertAggs(self.sampleAggs(), [False, False])
+        self.assertAggs(self.sampleAggs(), [False, False])
 
         log.info('#### up down(winner) || up')
         log.info('###########################')
-        docker_api.containers.get('referee').start()
-        aggs_failure, aggs = self.performFailure(NoFailure())
-
-        self.assertNoCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-        self.assertNoCommits(aggs)
-        self.assertIsolation(aggs)
-
-        self.client.get_aggregates(clean=False)
-        self.client.stop()
+        self.containers['referee'].start()
+        # sample once the referee is up, not its boot
+        self.awaitOnline(self.referee_dsn)
+        self.assertAggs(self.sampleAggs(), [False, False])
+        self.assertAggs(self.sampleAggs(), [False, False])
 
         log.info('#### up up(winner) || up')
         log.info('###########################')
-        docker_api.containers.get('node2').start()
-        self.awaitOnline(self.dsns[1])
-        self.awaitOnline(self.dsns[0])
-
-        self.client.bgrun()
-        time.sleep(3)
+        self.stopClientAndStart([self.containers['node2']], self.dsns)
 
-        # give it time to clean old decision
-        time.sleep(5)
+        self.bgrunDeferred()
 
         log.info('#### check that decision is cleaned')
         log.info('###########################')
-        con = psycopg2.connect(self.referee_dsn)
-        con.autocommit = True
-        cur = con.cursor()
-        cur.execute(
-            "select node_id from referee.decision where key = 'winner'")
-        decisions_count = cur.rowcount
-        cur.close()
-        con.close()
-
-        self.assertEqual(decisions_count, 0)
-
-    # test that winner continues working after restart
-    def test_winner_restart(self):
-        log.info('### test_winner_restart ###')
+        self._awaitDecisionCleaned()
 
+    # stop node1, fail the winner node2 with failure_class, ensure it
+    # continues working
+    def _checkWinnerFailure(self, failure_class):
         aggs_failure, aggs = self.performFailure(StopNode('node1'))
 
-        self.assertNoCommits(aggs_failure[:1])
-        self.assertCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs[:1])
-        self.assertCommits(aggs[1:])
-        self.assertIsolation(aggs)
+        self.assertAggs(aggs_failure, [False, True])
+        self.assertAggs(aggs, [False, True])
 
         aggs_failure, aggs = self.performFailure(
-            RestartNode('node2'), nodes_wait_for_commit=[1])
+            failure_class('node2'), nodes_wait_for_commit=[1])
 
-        self.assertNoCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs[:1])
-        self.assertCommits(aggs[1:])
-        self.assertIsolation(aggs)
-
-        self.client.get_aggregates(clean=False)
-        self.client.stop()
+        self.assertAggs(aggs_failure, [False, False])
+        self.assertAggs(aggs, [False, True])
 
         # need to start node1 to perform consequent tests
-        docker_api = docker.from_env()
-        docker_api.containers.get('node1').start()
-        self.awaitOnline(self.dsns[0])
+        self.stopClientAndStart([self.containers['node1']], [self.dsns[0]])
 
-        self.client.bgrun()
-        time.sleep(3)
+        self.bgrunDeferred()
+
+    def test_winner_restart(self):
+        log.info('### test_winner_restart ###')
+        self._checkWinnerFailure(RestartNode)
 
-    # test that winner continues working after crash-recover
     def test_winner_crash(self):
         log.info('### test_winner_crash ###')
-
-        aggs_failure, aggs = self.performFailure(StopNode('node1'))
-
-        self.assertNoCommits(aggs_failure[:1])
-        self.assertCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs[:1])
-        self.assertCommits(aggs[1:])
-        self.assertIsolation(aggs)
-
-        aggs_failure, aggs = self.performFailure(CrashRecoverNode('node2'),
-                                                 nodes_wait_for_commit=[1])
-
-        self.assertNoCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs[:1])
-        self.assertCommits(aggs[1:])
-        self.assertIsolation(aggs)
-
-        self.client.get_aggregates(clean=False)
-        self.client.stop()
-
-        # need to start node1 to perform consequent tests
-        docker_api = docker.from_env()
-        docker_api.containers.get('node1').start()
-        self.awaitOnline(self.dsns[0])
-
-        self.client.bgrun()
-        time.sleep(3)
+        self._checkWinnerFailure(CrashRecoverNode)
 
     # - get down node 1, ensure 2 works as winner
     # - get down node 2, ensure nothing is working
@@ -307,80 +159,53 @@ class RefereeTest(MMTestCase, TestHelper):
     # - get referee up, ensure grant is cleared
     def test_consequent_shutdown(self):
         log.info('### test_consequent_shutdown ###')
-        docker_api = docker.from_env()
 
         log.info('#### down on(winner) || on')
         log.info('##########################')
         aggs_failure, aggs = self.performFailure(StopNode('node1'))
 
-        self.assertNoCommits(aggs_failure[:1])
-        self.assertCommits(aggs_failure[1:])
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs[:1])
-        self.assertCommits(aggs[1:])
-        self.assertIsolation(aggs)
+        self.assertAggs(aggs_failure, [False, True])
+        self.assertAggs(aggs, [False, True])
 
         log.info('#### down down(winner) || on')
         log.info('############################')
         aggs_failure, aggs = self.performFailure(StopNode('node2'))
 
-        self.assertNoCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-
-        self.assertNoCommits(aggs)
-        self.assertIsolation(aggs)
+        self.assertAggs(aggs_failure, [False, False])
+        self.assertAggs(aggs, [False, False])
 
         log.info('#### down down(winner) || down')
         log.info('##############################')
-        docker_api.containers.get('referee').stop()
+        self.containers['referee'].stop()
         time.sleep(3)
 
         log.info('#### up down(winner) || down')
         log.info('############################')
-        docker_api.containers.get('node1').start()
-        aggs_failure, aggs = self.performFailure(NoFailure())
-
-        self.assertNoCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-        self.assertNoCommits(aggs)
-        self.assertIsolation(aggs)
+        self.containers['node1'].start()
+        # sample node1 once it is up, not its boot; select works on disabled
+        # node
+        self.awaitOnline(self.dsns[0])
+        self.assertAggs(self.sampleAggs(), [False, False])
+        self.assertAggs(self.sampleAggs(), [False, False])
 
         log.info('#### up up(winner) || down')
         log.info('##########################')
-        self.client.get_aggregates(clean=False)
-        self.client.stop()
-        docker_api.containers.get('node2').start()
-        self.awaitOnline(self.dsns[1])
-        self.awaitOnline(self.dsns[0])
-        self.client.bgrun()
-        time.sleep(3)
-
-        aggs_failure, aggs = self.performFailure(NoFailure())
+        self.stopClientAndStart([self.containers['node2']], self.dsns)
+        self.bgrunDeferred()
+        self.awaitCommit(0)
+        self.awaitCommit(1)
 
-        self.assertCommits(aggs_failure)
-        self.assertIsolation(aggs_failure)
-        self.assertCommits(aggs)
-        self.assertIsolation(aggs)
+        self.assertAggs(self.sampleAggs(), [True, True])
+        self.assertAggs(self.sampleAggs(), [True, True])
 
         log.info('#### up up || up(2 -> 0)')
         log.info('########################')
-        docker_api.containers.get('referee').start()
-        time.sleep(10)
+        self.containers['referee'].start()
 
         log.info('#### check that decision is cleaned')
         log.info('###################################')
         self.awaitOnline(self.referee_dsn)
-        con = psycopg2.connect(self.referee_dsn)
-        con.autocommit = True
-        cur = con.cursor()
-        cur.execute(
-            "select node_id from referee.decision where key = 'winner'")
-        decisions_count = cur.rowcount
-        cur.close()
-        con.close()
-
-        self.assertEqual(decisions_count, 0)
+        self._awaitDecisionCleaned()
 
 
 if __name__ == '__main__':
@@ -9,11 +9,7 @@ class RecoveryTest(unittest.TestCase, TestHelper):
 
     @classmethod
     def setUpClass(cls):
-        cls.dsns = [
-            "dbname=regression user=postgres host=127.0.0.1 port=15432",
-            "dbname=regression user=postgres host=127.0.0.1 port=15433",
-            "dbname=regression user=postgres host=127.0.0.1 port=15434"
-        ]
+        cls.dsns = [NODE1_DSN, NODE2_DSN, NODE3_DSN]
 
         print('setUp')
         subprocess.check_call(['docker-compose','up',